@@ -1,112 +1,441 @@
+import asyncio
+import atexit
+import contextlib
+import heapq
 import json
+import logging
 import os
-from datetime import datetime, date
+import threading
+import time
+from datetime import datetime, date, timedelta
 from typing import Dict, Any
+try:
+    import orjson  # быстрее stdlib json на больших файлах статистики
+except ImportError:
+    orjson = None
+
+_analytics_singleton = None
+
+def get_analytics() -> "BotAnalytics":
+    """Возвращает общий для процесса экземпляр аналитики"""
+    global _analytics_singleton
+    if _analytics_singleton is None:
+        _analytics_singleton = BotAnalytics()
+    return _analytics_singleton
 
 class BotAnalytics:
     """
     Простая система аналитики для Telegram бота.
-    Сохраняет статистику в JSON файл.
+    Каждое событие дописывается одной строкой в журнал (WAL),
+    а полный снимок статистики в JSON файл пишется периодически (checkpoint):
+    каждые FLUSH_EVERY событий или раз в FLUSH_INTERVAL секунд.
+    При старте снимок догоняется повтором журнала.
     """
-    
+
+    FLUSH_INTERVAL = 5  # секунд
+    FLUSH_EVERY = 50  # событий
+    TOP_K = 10  # размер кэша топа пользователей
+    DAILY_RETENTION_DAYS = 90  # старше — сворачиваем в monthly_stats
+
     def __init__(self, stats_file: str = "bot_stats.json"):
         self.stats_file = stats_file
+        self.wal_file = os.path.splitext(stats_file)[0] + ".wal"
         self.stats = self._load_stats()
-    
+        self._lsn = self.stats.get("lsn", 0)
+        self._wal = open(self.wal_file, 'a', encoding='utf-8', buffering=1)
+        self._dirty = False
+        self._events_since_flush = 0
+        self._last_flush = time.monotonic()
+        self._lock = asyncio.Lock()
+        # Запись снимка может идти из пула потоков — не даём двум записям пересечься
+        self._write_lock = threading.Lock()
+        self._saved_lsn = 0  # lsn последнего записанного снимка
+        self._save_failed = False
+        self._wal_failed = False
+        self._flush_requested = asyncio.Event()
+        self._flusher_running = False
+        self._build_top()
+        # Не теряем накопленное при нормальном завершении процесса
+        atexit.register(self.checkpoint)
+
     def _load_stats(self) -> Dict[str, Any]:
-        """Загружает статистику из файла"""
+        """Загружает снимок статистики из файла и повторяет журнал поверх него"""
+        stats = None
         if os.path.exists(self.stats_file):
             try:
-                with open(self.stats_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                if orjson:
+                    with open(self.stats_file, 'rb') as f:
+                        stats = orjson.loads(f.read())
+                else:
+                    with open(self.stats_file, 'r', encoding='utf-8') as f:
+                        stats = json.load(f)
+            # orjson.JSONDecodeError наследуется от json.JSONDecodeError
             except (json.JSONDecodeError, FileNotFoundError):
                 pass
-        
-        # Инициализируем пустую статистику
-        return {
-            "total_users": 0,
-            "total_messages": 0,
-            "total_voice_messages": 0,
-            "total_searches": 0,
-            "users": {},
-            "daily_stats": {},
-            "start_date": datetime.now().isoformat()
-        }
-    
-    def _save_stats(self):
-        """Сохраняет статистику в файл"""
+
+        if stats is None:
+            # Инициализируем пустую статистику
+            stats = {
+                "total_users": 0,
+                "total_messages": 0,
+                "total_voice_messages": 0,
+                "total_searches": 0,
+                "users": {},
+                "daily_stats": {},
+                "start_date": datetime.now().isoformat(),
+                "lsn": 0
+            }
+
+        self._rollup_old_days(stats)
+
+        # id уникальных пользователей храним (множеством) только для последнего дня:
+        # прошлые дни уже не пополняются, и для них достаточно unique_users_count
+        latest_day = max(stats["daily_stats"], default=None)
+        for day, daily in stats["daily_stats"].items():
+            users = daily.pop("unique_users", None)
+            if day == latest_day and users is not None:
+                daily["unique_users"] = set(users)
+
+        self._replay_wal(stats)
+        return stats
+
+    def _rollup_old_days(self, stats: Dict[str, Any]):
+        """Сворачивает ежедневную статистику старше DAILY_RETENTION_DAYS в помесячную"""
+        cutoff = (date.today() - timedelta(days=self.DAILY_RETENTION_DAYS)).isoformat()
+        old_days = [day for day in stats["daily_stats"] if day < cutoff]
+        if not old_days:
+            return
+        monthly_stats = stats.setdefault("monthly_stats", {})
+        for day in old_days:
+            daily = stats["daily_stats"].pop(day)
+            month = monthly_stats.setdefault(day[:7], {
+                "messages": 0,
+                "voice_messages": 0,
+                "searches": 0,
+                # сумма дневных уникальных, а не число уникальных за месяц
+                "unique_users_sum": 0
+            })
+            month["messages"] += daily.get("messages", 0)
+            month["voice_messages"] += daily.get("voice_messages", 0)
+            month["searches"] += daily.get("searches", 0)
+            month["unique_users_sum"] += daily.get("unique_users_count", 0)
+
+    def _replay_wal(self, stats: Dict[str, Any]):
+        """Применяет к снимку события из журнала, записанные после него"""
+        if not os.path.exists(self.wal_file):
+            return
+        snapshot_lsn = stats.get("lsn", 0)
+        with open(self.wal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # Оборванная последняя строка после падения процесса
+                    continue
+                if event["lsn"] > snapshot_lsn:
+                    self._apply_event(stats, event)
+
+    def _snapshot(self) -> Dict[str, Any]:
+        """
+        Копия статистики для записи на диск.
+        Копируем всё, что меняется между событиями, чтобы запись могла идти в другом потоке.
+        """
+        snapshot = dict(self.stats)
+        snapshot["users"] = {user_key: dict(data) for user_key, data in self.stats["users"].items()}
+        snapshot["daily_stats"] = {day: dict(daily) for day, daily in self.stats["daily_stats"].items()}
+        # Множества в JSON не сериализуются — пишем их отсортированными списками
+        for daily in snapshot["daily_stats"].values():
+            if "unique_users" in daily:
+                daily["unique_users"] = sorted(daily["unique_users"])
+        return snapshot
+
+    def _save_stats(self, snapshot: Dict[str, Any]) -> bool:
+        """Сохраняет снимок статистики в файл"""
+        # Пишем во временный файл и атомарно подменяем им основной,
+        # чтобы падение посреди записи не оставило оборванный JSON
+        tmp_file = self.stats_file + ".tmp"
         try:
-            with open(self.stats_file, 'w', encoding='utf-8') as f:
-                json.dump(self.stats, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"Ошибка сохранения статистики: {e}")
-    
-    def track_user_message(self, user_id: int, username: str = "Unknown", is_voice: bool = False):
-        """Отслеживает сообщение от пользователя"""
-        today = date.today().isoformat()
+            with self._write_lock:
+                # Снимок из пула потоков мог задержаться (например, при остановке бота),
+                # пока синхронный checkpoint уже записал более новый — старым его не затираем
+                if snapshot.get("lsn", 0) < self._saved_lsn:
+                    return True
+                if orjson:
+                    with open(tmp_file, 'wb') as f:
+                        f.write(orjson.dumps(snapshot, option=orjson.OPT_INDENT_2))
+                        f.flush()
+                        os.fsync(f.fileno())
+                else:
+                    with open(tmp_file, 'w', encoding='utf-8') as f:
+                        json.dump(snapshot, f, ensure_ascii=False, indent=2)
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(tmp_file, self.stats_file)
+                self._saved_lsn = snapshot.get("lsn", 0)
+        except OSError:
+            logging.exception("Ошибка сохранения статистики")
+            self._save_failed = True
+            return False
+        if self._save_failed:
+            logging.info("Сохранение статистики восстановлено")
+            self._save_failed = False
+        return True
+
+    def _log_event(self, event: Dict[str, Any]):
+        """Дописывает событие в журнал и применяет его к статистике в памяти"""
+        self._lsn += 1
+        event["lsn"] = self._lsn
+        try:
+            self._wal.write(json.dumps(event, ensure_ascii=False) + "\n")
+        except OSError:
+            # Аналитика не должна ломать ответы: событие остаётся в памяти до ближайшего checkpoint.
+            # Логируем только первый сбой подряд, чтобы не засыпать лог на каждом сообщении
+            if not self._wal_failed:
+                logging.exception("Ошибка записи журнала статистики")
+                self._wal_failed = True
+        else:
+            if self._wal_failed:
+                logging.info("Запись журнала статистики восстановлена")
+                self._wal_failed = False
+        self._apply_event(self.stats, event)
+        self._mark_dirty()
+
+    def _mark_dirty(self):
+        """Помечает статистику изменённой и запрашивает checkpoint, если пора"""
+        self._dirty = True
+        self._events_since_flush += 1
+        if (self._events_since_flush >= self.FLUSH_EVERY
+                or time.monotonic() - self._last_flush > self.FLUSH_INTERVAL):
+            if self._flusher_running:
+                # Запись сделает flush_loop в отдельном потоке, не блокируя event loop
+                self._flush_requested.set()
+            else:
+                self.checkpoint()
+
+    def checkpoint(self):
+        """Пишет полный снимок статистики на диск и очищает журнал"""
+        if not self._dirty:
+            return
+        lsn = self._lsn
+        self._finish_checkpoint(lsn, self._save_stats(self._snapshot()))
+
+    async def checkpoint_async(self):
+        """То же, что checkpoint, но запись на диск идёт в пуле потоков"""
+        if not self._dirty:
+            return
+        lsn = self._lsn
+        snapshot = self._snapshot()
+        saved = await asyncio.to_thread(self._save_stats, snapshot)
+        self._finish_checkpoint(lsn, saved)
+
+    def _finish_checkpoint(self, lsn: int, saved: bool):
+        if not saved:
+            # Снимок не записался — журнал остаётся единственной копией событий
+            return
+        # Пока снимок писался, в журнал могли дописаться новые события:
+        # тогда журнал не трогаем, при повторе старые записи отсекаются по lsn
+        if self._lsn == lsn:
+            self._wal.seek(0)
+            self._wal.truncate()
+        self._events_since_flush = self._lsn - lsn
+        self._dirty = self._events_since_flush > 0
+        self._last_flush = time.monotonic()
+
+    async def flush_loop(self):
+        """Фоновая задача: делает checkpoint раз в FLUSH_INTERVAL секунд или по запросу"""
+        self._flusher_running = True
+        try:
+            while True:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._flush_requested.wait(), timeout=self.FLUSH_INTERVAL)
+                self._flush_requested.clear()
+                # Сбой одного checkpoint не должен останавливать цикл (и бота вместе с ним)
+                try:
+                    async with self._lock:
+                        await self.checkpoint_async()
+                except Exception:
+                    logging.exception("Ошибка checkpoint статистики")
+        finally:
+            self._flusher_running = False
+
+    def _apply_event(self, stats: Dict[str, Any], event: Dict[str, Any]):
+        """Применяет одно событие журнала к агрегированной статистике"""
+        stats["lsn"] = event["lsn"]
+        if event["e"] == "msg":
+            self._apply_user_message(stats, event)
+        elif event["e"] == "search":
+            self._apply_search(stats, event)
+
+    def _apply_user_message(self, stats: Dict[str, Any], event: Dict[str, Any]):
+        today = event["t"][:10]
+        user_id = event["uid"]
         user_key = str(user_id)
-        
+        username = event.get("name")
+        is_voice = event.get("voice", False)
+
         # Общая статистика
-        self.stats["total_messages"] += 1
+        stats["total_messages"] += 1
         if is_voice:
-            self.stats["total_voice_messages"] += 1
-        
+            stats["total_voice_messages"] += 1
+
         # Статистика пользователя
-        if user_key not in self.stats["users"]:
-            self.stats["total_users"] += 1
-            self.stats["users"][user_key] = {
+        if user_key not in stats["users"]:
+            stats["total_users"] += 1
+            stats["users"][user_key] = {
                 "username": username,
-                "first_seen": datetime.now().isoformat(),
+                "first_seen": event["t"],
                 "messages_count": 0,
                 "voice_messages_count": 0,
                 "searches_triggered": 0
             }
-        
+
         # Обновляем данные пользователя
-        user_stats = self.stats["users"][user_key]
+        user_stats = stats["users"][user_key]
         user_stats["messages_count"] += 1
-        user_stats["last_seen"] = datetime.now().isoformat()
+        user_stats["last_seen"] = event["t"]
         if username:
             user_stats["username"] = username
         if is_voice:
             user_stats["voice_messages_count"] += 1
-        
+
         # Ежедневная статистика
-        if today not in self.stats["daily_stats"]:
-            self.stats["daily_stats"][today] = {
+        if today not in stats["daily_stats"]:
+            # Начался новый день: id пользователей прошлых дней больше не нужны
+            for past in stats["daily_stats"].values():
+                past.pop("unique_users", None)
+            stats["daily_stats"][today] = {
                 "messages": 0,
                 "voice_messages": 0,
-                "unique_users": [],
+                "unique_users": set(),
+                "unique_users_count": 0,
                 "searches": 0
             }
-        
-        daily = self.stats["daily_stats"][today]
+
+        daily = stats["daily_stats"][today]
         daily["messages"] += 1
         if is_voice:
             daily["voice_messages"] += 1
-        
-        # Добавляем пользователя в список, если его там еще нет
-        if user_id not in daily["unique_users"]:
-            daily["unique_users"].append(user_id)
-        
-        daily["unique_users_count"] = len(daily["unique_users"])
-        
-        self._save_stats()
-    
-    def track_search(self, user_id: int, search_query: str):
-        """Отслеживает использование поиска"""
-        today = date.today().isoformat()
+
+        users_today = daily.setdefault("unique_users", set())
+        if user_id not in users_today:
+            users_today.add(user_id)
+            daily["unique_users_count"] = daily.get("unique_users_count", 0) + 1
+
+        # "q" — формат журнала до того, как текст запроса перестал писаться на диск
+        if event.get("search") or "q" in event:
+            self._apply_search(stats, event)
+
+    def _apply_search(self, stats: Dict[str, Any], event: Dict[str, Any]):
+        today = event["t"][:10]
+        user_key = str(event["uid"])
+
+        stats["total_searches"] += 1
+
+        if user_key in stats["users"]:
+            stats["users"][user_key]["searches_triggered"] += 1
+
+        if today in stats["daily_stats"]:
+            stats["daily_stats"][today]["searches"] += 1
+
+    def _build_top(self):
+        """Собирает кэш топа пользователей: min-куча (messages_count, user_key) размера TOP_K"""
+        top = heapq.nlargest(
+            self.TOP_K,
+            ((data["messages_count"], user_key) for user_key, data in self.stats["users"].items())
+        )
+        # Список по возрастанию уже является корректной min-кучей
+        top.reverse()
+        self._top_cache = top
+        self._top_index = {user_key: i for i, (_, user_key) in enumerate(top)}
+
+    def _update_top(self, user_key: str, count: int):
+        """Обновляет кэш топа после роста счётчика сообщений пользователя"""
+        heap = self._top_cache
+        pos = self._top_index.get(user_key)
+        if pos is None:
+            if len(heap) < self.TOP_K:
+                heap.append((count, user_key))
+                self._top_index[user_key] = len(heap) - 1
+                self._sift_up(len(heap) - 1)
+                return
+            if (count, user_key) <= heap[0]:
+                return
+            # Вытесняем самого слабого из топа
+            del self._top_index[heap[0][1]]
+            pos = 0
+        # Счётчики только растут, поэтому элемент может опуститься только вниз кучи
+        heap[pos] = (count, user_key)
+        self._top_index[user_key] = pos
+        self._sift_down(pos)
+
+    def _sift_up(self, pos: int):
+        heap = self._top_cache
+        while pos > 0:
+            parent = (pos - 1) // 2
+            if heap[parent] <= heap[pos]:
+                break
+            self._swap_top(pos, parent)
+            pos = parent
+
+    def _sift_down(self, pos: int):
+        heap = self._top_cache
+        size = len(heap)
+        while True:
+            child = 2 * pos + 1
+            if child >= size:
+                break
+            if child + 1 < size and heap[child + 1] < heap[child]:
+                child += 1
+            if heap[pos] <= heap[child]:
+                break
+            self._swap_top(pos, child)
+            pos = child
+
+    def _swap_top(self, i: int, j: int):
+        heap = self._top_cache
+        heap[i], heap[j] = heap[j], heap[i]
+        self._top_index[heap[i][1]] = i
+        self._top_index[heap[j][1]] = j
+
+    def track_event(
+        self,
+        user_id: int,
+        username: str = "Unknown",
+        is_voice: bool = False,
+        search_query: str | None = None
+    ):
+        """
+        Отслеживает сообщение пользователя и (если был) запущенный им поиск
+        одним событием журнала
+        """
+        event = {
+            "e": "msg",
+            "t": datetime.now().isoformat(),
+            "uid": user_id,
+            "name": username,
+            "voice": is_voice
+        }
+        if search_query is not None:
+            # Сам текст запроса (это реплика пользователя) на диск не пишем — нужен только факт поиска
+            event["search"] = True
+        self._log_event(event)
         user_key = str(user_id)
-        
-        self.stats["total_searches"] += 1
-        
-        if user_key in self.stats["users"]:
-            self.stats["users"][user_key]["searches_triggered"] += 1
-        
-        if today in self.stats["daily_stats"]:
-            self.stats["daily_stats"][today]["searches"] += 1
-        
-        self._save_stats()
+        self._update_top(user_key, self.stats["users"][user_key]["messages_count"])
+
+    def track_user_message(self, user_id: int, username: str = "Unknown", is_voice: bool = False):
+        """Отслеживает сообщение от пользователя"""
+        self.track_event(user_id, username, is_voice=is_voice)
+
+    def track_search(self, user_id: int, search_query: str):
+        """
+        Отслеживает использование поиска отдельно от сообщения (см. track_event).
+        Текст запроса в журнал не попадает.
+        """
+        self._log_event({
+            "e": "search",
+            "t": datetime.now().isoformat(),
+            "uid": user_id
+        })
     
     def get_summary(self) -> str:
         """Возвращает краткую сводку статистики"""
@@ -129,20 +458,20 @@ class BotAnalytics:
     
     def get_top_users(self, limit: int = 10) -> str:
         """Возвращает топ активных пользователей"""
-        users = []
-        for user_id, data in self.stats["users"].items():
-            users.append({
-                "username": data.get("username", "Unknown"),
-                "messages": data["messages_count"],
-                "voice": data["voice_messages_count"],
-                "searches": data["searches_triggered"]
-            })
-        
-        # Сортируем по количеству сообщений
-        users.sort(key=lambda x: x["messages"], reverse=True)
+        if limit <= self.TOP_K:
+            top = sorted(self._top_cache, reverse=True)[:limit]
+        else:
+            top = heapq.nlargest(
+                limit,
+                ((data["messages_count"], user_key) for user_key, data in self.stats["users"].items())
+            )
         
-        result = f"🏆 Топ {min(limit, len(users))} активных пользователей:\n\n"
-        for i, user in enumerate(users[:limit], 1):
-            result += f"{i}. @{user['username']}: {user['messages']} сообщений ({user['voice']} голосовых, {user['searches']} поисков)\n"
+        parts = [f"🏆 Топ {len(top)} активных пользователей:\n\n"]
+        for i, (_, user_key) in enumerate(top, 1):
+            user = self.stats["users"][user_key]
+            parts.append(
+                f"{i}. @{user.get('username', 'Unknown')}: {user['messages_count']} сообщений "
+                f"({user['voice_messages_count']} голосовых, {user['searches_triggered']} поисков)\n"
+            )
         
-        return result
\ No newline at end of file
+        return "".join(parts)
\ No newline at end of file
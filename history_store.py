@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Dict, List
+try:
+    import orjson  # быстрее stdlib json при сериализации истории
+except ImportError:
+    orjson = None
+
+def _dumps(messages: list) -> bytes:
+    if orjson:
+        return orjson.dumps(messages)
+    return json.dumps(messages, ensure_ascii=False).encode('utf-8')
+
+def _loads(data: bytes) -> list:
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+class HistoryStore:
+    """
+    История диалогов по чатам: кольцевые буферы в памяти + SQLite на диске,
+    чтобы контекст переживал перезапуск бота.
+    Чтение ленивое — история чата поднимается с диска при первом обращении.
+    Запись отложенная — хендлеры только помечают чат изменённым,
+    а flush_loop раз в FLUSH_INTERVAL секунд сбрасывает такие чаты в базу.
+    """
+
+    FLUSH_INTERVAL = 2  # секунд
+    EVICTION_INTERVAL = 60 * 60  # секунд
+
+    def __init__(
+        self,
+        db_file: str = "bot_history.sqlite3",
+        max_messages: int = 40,
+        idle_ttl: float = 24 * 60 * 60
+    ):
+        self.db_file = db_file
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self._histories: Dict[str, deque] = {}
+        self._last_used: Dict[str, float] = {}
+        self._dirty = set()
+        # Соединение используется из пула потоков, поэтому запросы к нему сериализуем
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS history("
+            "chat_key TEXT PRIMARY KEY, messages BLOB, updated_at REAL)"
+        )
+        self._conn.commit()
+
+    def _new_history(self) -> deque:
+        return deque(maxlen=self.max_messages)
+
+    def _load_rows(self, chat_key: str) -> List[dict]:
+        """Читает историю чата из базы; истории старше idle_ttl считаются забытыми"""
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT messages FROM history WHERE chat_key = ? AND updated_at >= ?",
+                (chat_key, time.time() - self.idle_ttl)
+            ).fetchone()
+        return _loads(row[0]) if row else []
+
+    def _save_rows(self, rows: List[tuple]):
+        with self._db_lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO history(chat_key, messages, updated_at) VALUES (?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+
+    def _delete_stale_rows(self, older_than: float):
+        with self._db_lock:
+            self._conn.execute("DELETE FROM history WHERE updated_at < ?", (older_than,))
+            self._conn.commit()
+
+    async def get(self, chat_key: str) -> deque:
+        """История чата; при первом обращении поднимается из базы. Заодно отмечает активность."""
+        self._last_used[chat_key] = time.time()
+        history = self._histories.get(chat_key)
+        if history is not None:
+            return history
+
+        messages = await asyncio.to_thread(self._load_rows, chat_key)
+        # Пока читали базу, историю мог создать параллельный хендлер того же чата
+        history = self._histories.get(chat_key)
+        if history is None:
+            history = self._histories[chat_key] = self._new_history()
+            history.extend(messages)
+        return history
+
+    def reset(self, chat_key: str):
+        """Начинает историю чата с чистого листа"""
+        self._histories[chat_key] = self._new_history()
+        self._last_used[chat_key] = time.time()
+        self.mark_dirty(chat_key)
+
+    def mark_dirty(self, chat_key: str):
+        """Помечает историю чата изменённой — она уйдёт в базу при ближайшем flush"""
+        self._dirty.add(chat_key)
+
+    def _take_dirty_rows(self) -> List[tuple]:
+        now = time.time()
+        rows = [
+            (chat_key, _dumps(list(self._histories[chat_key])), now)
+            for chat_key in self._dirty
+            if chat_key in self._histories
+        ]
+        self._dirty.clear()
+        return rows
+
+    async def flush(self):
+        """Сбрасывает изменённые истории в базу (запись идёт в пуле потоков)"""
+        if not self._dirty:
+            return
+        # Сериализуем на потоке event loop, где истории и меняются
+        rows = self._take_dirty_rows()
+        try:
+            await asyncio.to_thread(self._save_rows, rows)
+        except Exception:
+            logging.exception("Ошибка сохранения истории диалогов")
+            # Повторим при следующем flush
+            self._dirty.update(chat_key for chat_key, _, _ in rows)
+
+    async def flush_loop(self):
+        """Фоновая задача: периодически сбрасывает изменённые истории в базу"""
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            # Сбой одного сброса не должен останавливать цикл (и бота вместе с ним)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Ошибка сброса истории диалогов")
+
+    async def eviction_loop(self):
+        """Фоновая задача: забывает чаты, неактивные дольше idle_ttl"""
+        while True:
+            await asyncio.sleep(self.EVICTION_INTERVAL)
+            cutoff = time.time() - self.idle_ttl
+            idle = [chat_key for chat_key, last_used in self._last_used.items() if last_used < cutoff]
+            for chat_key in idle:
+                self._histories.pop(chat_key, None)
+                self._last_used.pop(chat_key, None)
+                self._dirty.discard(chat_key)
+            try:
+                await asyncio.to_thread(self._delete_stale_rows, cutoff)
+            except Exception:
+                logging.exception("Ошибка очистки старой истории диалогов")
+            if idle:
+                logging.info(f"Удалена история {len(idle)} неактивных чатов")
+
+    def close(self):
+        """Синхронно сбрасывает оставшиеся изменения и закрывает базу"""
+        rows = self._take_dirty_rows()
+        if rows:
+            self._save_rows(rows)
+        with self._db_lock:
+            self._conn.close()
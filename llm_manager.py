@@ -1,54 +1,120 @@
 import os
 import asyncio
-from openai import OpenAI  # Библиотека openai теперь используется для работы с DeepSeek
+import concurrent.futures
+import functools
+from cachetools import TTLCache
+from openai import AsyncOpenAI  # Библиотека openai теперь используется для работы с DeepSeek
 from googleapiclient.discovery import build
 import logging
 import re
+import time
+from typing import BinaryIO
 
 # Импортируем ключи через модуль config, который заранее загружает переменные окружения
 from config import (
     DEEPSEEK_API_KEY,
+    OPENAI_API_KEY,
     GOOGLE_SEARCH_API_KEY,
     CUSTOM_SEARCH_ENGINE_ID,
 )
+from analytics import BotAnalytics, get_analytics
+
+# Регулярки для convert_markdown_to_html, компилируются один раз при импорте
+_RE_LINK = re.compile(r'\[(.*?)\]\((.*?)\)')
+_RE_BOLD = re.compile(r'\*\*(.*?)\*\*')
+_RE_ITALIC = re.compile(r'\*(.*?)\*')
+
+# Ключевые слова, при которых к ответу подмешиваются результаты поиска
+SEARCH_KEYWORDS = [
+    "актуальн", "сейчас", "сегодня", "вчера", "завтра", "недавно",
+    "новости", "цены", "расписание", "работает", "открыт", "закрыт",
+    "время работы", "курс", "валют", "обмен", "погода", "отзывы"
+]
+# Одна скомпилированная альтернатива вместо цикла по ключевым словам
+_SEARCH_RE = re.compile("|".join(map(re.escape, SEARCH_KEYWORDS)), re.IGNORECASE)
+# Запрос короче самого короткого ключевого слова отсекаем без регулярки
+_MIN_KW_LEN = min(len(keyword) for keyword in SEARCH_KEYWORDS)
+
+# База знаний бота, из которой собирается системный промпт
+KNOWLEDGE_FILE = 'bot_knowledge.md'
+# Как часто (в секундах) проверять, не изменился ли файл базы знаний
+KNOWLEDGE_CHECK_INTERVAL = 30
+DEFAULT_SYSTEM_PROMPT = (
+    "Ты - эксперт по Пхукету, дружелюбный и знающий местный житель. "
+    "Отвечай кратко, без \"воды\", всегда давай только полезные советы. Используй emojis. "
+    "Используй HTML-разметку (теги <b>, <i>) для выделения важных моментов."
+)
+
+# Свой пул потоков для блокирующих запросов к Google, чтобы не делить общий пул с прочими задачами
+_SEARCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="gsearch")
+
+# Кэш результатов поиска: обычные запросы живут 5 минут,
+# запросы про "сегодня"/"сейчас" — минуту, чтобы не отдавать устаревшее
+SEARCH_CACHE_TTL = 300
+SEARCH_CACHE_FRESH_TTL = 60
+_FRESH_QUERY_WORDS = ("сегодня", "сейчас")
+
+@functools.lru_cache(maxsize=4)
+def _build_cse(api_key: str):
+    """Сервис Custom Search строится один раз на ключ и переиспользуется всеми экземплярами"""
+    return build("customsearch", "v1", developerKey=api_key)
 
 # Класс для работы с поисковиком Google
 class GoogleSearch:
     def __init__(self, api_key: str, cse_id: str):
         self.api_key = api_key
         self.cse_id = cse_id
-        self.service = build("customsearch", "v1", developerKey=self.api_key)
+        self.service = _build_cse(self.api_key)
+        # Кэши трогаются только из event loop, поэтому блокировки не нужны
+        self._cache = TTLCache(maxsize=512, ttl=SEARCH_CACHE_TTL)
+        self._fresh_cache = TTLCache(maxsize=128, ttl=SEARCH_CACHE_FRESH_TTL)
+
+    def _do_search(self, query: str, num: int):
+        return self.service.cse().list(
+            q=query,
+            cx=self.cse_id,
+            num=num
+        ).execute()
 
     async def search(self, query: str, num: int = 5):
+        key = (query.lower().strip(), num)
+        cache = self._fresh_cache if any(word in key[0] for word in _FRESH_QUERY_WORDS) else self._cache
+        # Один lookup вместо "in" + чтения: запись может истечь между ними, и TTLCache бросит KeyError
         try:
-            loop = asyncio.get_event_loop()
-            res = await loop.run_in_executor(
-                None,
-                lambda: self.service.cse().list(
-                    q=query,
-                    cx=self.cse_id,
-                    num=num
-                ).execute()
-            )
+            return cache[key]
+        except KeyError:
+            pass
+        try:
+            loop = asyncio.get_running_loop()
+            res = await loop.run_in_executor(_SEARCH_EXECUTOR, self._do_search, query, num)
             if 'items' not in res:
                 logging.warning("Поиск не дал результатов.")
+                cache[key] = []
                 return []
-            return res.get('items', [])
+            items = res.get('items', [])
+            cache[key] = items
+            return items
         except Exception as e:
             logging.error(f"Ошибка при поиске Google: {e}", exc_info=True)
             return []
 
+class StreamInterrupted(Exception):
+    """Поток ответа оборвался посреди генерации — полученный текст неполный"""
+
 class LLMManager:
     """
     Класс для управления и выбора языковых моделей.
     """
-    def __init__(self):
+    def __init__(self, analytics: BotAnalytics | None = None):
         if not DEEPSEEK_API_KEY:
             raise RuntimeError("DEEPSEEK_API_KEY is missing")
-        self.deepseek_client = OpenAI(
+        self.deepseek_client = AsyncOpenAI(
             api_key=DEEPSEEK_API_KEY,
             base_url="https://api.deepseek.com/v1"
         )
+        self.analytics = analytics or get_analytics()
+        # Один клиент на процесс: переиспользуем пул соединений и TLS-сессии
+        self.openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
         if GOOGLE_SEARCH_API_KEY and CUSTOM_SEARCH_ENGINE_ID:
             self.google_search_client = GoogleSearch(
                 api_key=GOOGLE_SEARCH_API_KEY,
@@ -57,22 +123,71 @@ class LLMManager:
         else:
             self.google_search_client = None
 
-    def _convert_markdown_to_html(self, text: str) -> str:
+        self._kb_mtime = None
+        self._kb_checked_at = 0.0
+        # Растёт при каждой смене системного промпта — по нему внешние кэши отличают устаревшие ответы
+        self._kb_version = 0
+        self._system_prompt_base = DEFAULT_SYSTEM_PROMPT
+        self._maybe_reload_kb(force=True)
+
+    @property
+    def knowledge_version(self) -> int:
+        """Версия системного промпта; заодно перечитывает базу знаний, если файл изменился"""
+        self._maybe_reload_kb()
+        return self._kb_version
+
+    def _maybe_reload_kb(self, force: bool = False):
+        """
+        Перечитывает базу знаний, только если файл изменился.
+        mtime проверяется не чаще раза в KNOWLEDGE_CHECK_INTERVAL секунд.
+        """
+        now = time.monotonic()
+        if not force and now - self._kb_checked_at < KNOWLEDGE_CHECK_INTERVAL:
+            return
+        self._kb_checked_at = now
+        try:
+            mtime = os.stat(KNOWLEDGE_FILE).st_mtime
+            if mtime == self._kb_mtime:
+                return
+            with open(KNOWLEDGE_FILE, 'r', encoding='utf-8') as f:
+                self._system_prompt_base = f.read()
+            self._kb_mtime = mtime
+            self._kb_version += 1
+        except FileNotFoundError:
+            if self._kb_mtime is not None:
+                self._kb_version += 1
+            self._system_prompt_base = DEFAULT_SYSTEM_PROMPT
+            self._kb_mtime = None
+
+    def convert_markdown_to_html(self, text: str) -> str:
         """
         Конвертирует базовый Markdown-формат в HTML для корректного отображения в Telegram.
         """
         # Сначала преобразуем ссылки, так как они могут содержать скобки и другие символы
-        text = re.sub(r'\[(.*?)\]\((.*?)\)', r'<a href="\2">\1</a>', text)
+        text = _RE_LINK.sub(r'<a href="\2">\1</a>', text)
         # Затем жирный текст
-        text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
+        text = _RE_BOLD.sub(r'<b>\1</b>', text)
         # Затем курсив
-        text = re.sub(r'\*(.*?)\*', r'<i>\1</i>', text)
+        text = _RE_ITALIC.sub(r'<i>\1</i>', text)
         return text
 
-    async def get_deepseek_response(self, user_messages: list, user_id: int = 0):
+    async def _prepare_messages(
+        self,
+        user_messages: list,
+        user_id: int = 0,
+        username: str = "Unknown",
+        is_voice: bool = False
+    ) -> list[dict]:
+        """
+        Собирает итоговый список сообщений для модели:
+        системный промпт из базы знаний + история + результаты поиска (если нужен)
+        отдельным сообщением перед последней репликой пользователя.
+        Сообщение пользователя и запущенный им поиск пишутся в аналитику одним событием.
+        """
         last_user_prompt = user_messages[-1]['content']
         search_needed = self.check_if_search_needed(last_user_prompt)
 
+        search_query = None
         search_info = ""
         if search_needed and self.google_search_client:
             if "отзывы" in last_user_prompt.lower():
@@ -81,153 +196,179 @@ class LLMManager:
                 search_query = last_user_prompt
 
             logging.info(f"Выполняем поиск по запросу: {search_query}")
-            
-            if user_id:
-                try:
-                    from analytics import BotAnalytics
-                    analytics = BotAnalytics()
-                    analytics.track_search(user_id, search_query)
-                except ImportError:
-                    pass
-            
+
+        if user_id:
+            self.analytics.track_event(user_id, username, is_voice=is_voice, search_query=search_query)
+
+        if search_query:
             search_results = await self.google_search_client.search(search_query)
 
             if search_results:
-                for item in search_results:
-                    search_info += f"Заголовок: {item.get('title')}\n"
-                    search_info += f"Ссылка: {item.get('link')}\n"
-                    search_info += f"Описание: {item.get('snippet')}\n\n"
+                search_info = "".join(
+                    f"Заголовок: {item.get('title')}\n"
+                    f"Ссылка: {item.get('link')}\n"
+                    f"Описание: {item.get('snippet')}\n\n"
+                    for item in search_results
+                )
 
-        try:
-            with open('bot_knowledge.md', 'r', encoding='utf-8') as f:
-                system_prompt = f.read()
-        except FileNotFoundError:
-            system_prompt = (
-                "Ты - эксперт по Пхукету, дружелюбный и знающий местный житель. "
-                "Отвечай кратко, без \"воды\", всегда давай только полезные советы. Используй emojis. "
-                "Используй HTML-разметку (теги <b>, <i>) для выделения важных моментов."
-            )
+        self._maybe_reload_kb()
+        # user_messages может быть и deque, поэтому распаковываем, а не складываем списки
+        messages = [{"role": "system", "content": self._system_prompt_base}, *user_messages]
 
         if search_info:
-            system_prompt += f"\n\nАктуальная информация из поиска:\n{search_info}"
+            # Динамический контекст идёт отдельным сообщением перед последней репликой:
+            # префикс (системный промпт + история) остаётся неизменным и попадает в кэш промптов провайдера
+            messages.insert(-1, {"role": "system", "content": f"Актуальная информация из поиска:\n{search_info}"})
+
+        return messages
 
-        messages = [{"role": "system", "content": system_prompt}] + user_messages
+    async def get_deepseek_response(
+        self,
+        user_messages: list,
+        user_id: int = 0,
+        username: str = "Unknown",
+        is_voice: bool = False
+    ):
+        messages = await self._prepare_messages(user_messages, user_id, username, is_voice)
+        return await self._deepseek_completion(messages)
 
+    async def _deepseek_completion(self, messages: list):
         try:
-            response = self.deepseek_client.chat.completions.create(
+            response = await self.deepseek_client.chat.completions.create(
                 model="deepseek-chat",
                 messages=messages,
                 max_tokens=4000,
                 temperature=0.7
             )
-            return self._convert_markdown_to_html(response.choices[0].message.content)
+            return self.convert_markdown_to_html(response.choices[0].message.content)
         except Exception as e:
             logging.error(f"Ошибка при работе с DeepSeek API: {e}", exc_info=True)
             return None
 
+    async def _stream_completion(self, client: AsyncOpenAI, model: str, messages: list):
+        """
+        Стримит куски ответа модели.
+        Ошибку до первого куска логирует и просто завершает поток (можно попробовать другую модель);
+        обрыв после первого куска — StreamInterrupted, чтобы обрезанный ответ не приняли за полный.
+        """
+        got_any = False
+        finished = False
+        try:
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=4000,
+                temperature=0.7,
+                stream=True
+            )
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    got_any = True
+                    yield choice.delta.content
+                if choice.finish_reason:
+                    finished = True
+        except Exception as e:
+            logging.error(f"Ошибка при стриминге ответа {model}: {e}", exc_info=True)
+            if got_any:
+                raise StreamInterrupted(model) from e
+            return
+        if got_any and not finished:
+            logging.error(f"Стриминг ответа {model} завершился без finish_reason")
+            raise StreamInterrupted(model)
+
+    async def stream_response(
+        self,
+        user_messages: list,
+        model_name: str = "deepseek",
+        user_id: int = 0,
+        username: str = "Unknown",
+        is_voice: bool = False
+    ):
+        """
+        Потоковый вариант get_response: async-итератор по кускам ответа.
+        Куски — сырой Markdown; для Telegram собранный ответ прогоняют через convert_markdown_to_html.
+        Если поток оборвался посреди ответа, бросает StreamInterrupted.
+        """
+        messages = await self._prepare_messages(user_messages, user_id, username, is_voice)
+
+        if model_name == "openai" and self.openai_client:
+            got_any = False
+            async for piece in self._stream_completion(self.openai_client, "gpt-3.5-turbo", messages):
+                got_any = True
+                yield piece
+            if got_any:
+                return
+            # OpenAI ничего не вернул — как и в get_openai_response, падаем на DeepSeek
+
+        async for piece in self._stream_completion(self.deepseek_client, "deepseek-chat", messages):
+            yield piece
+
     def check_if_search_needed(self, prompt: str) -> bool:
         """
         Определяет, нужен ли поиск для ответа на запрос.
         """
-        search_keywords = [
-            "актуальн", "сейчас", "сегодня", "вчера", "завтра", "недавно",
-            "новости", "цены", "расписание", "работает", "открыт", "закрыт",
-            "время работы", "курс", "валют", "обмен", "погода", "отзывы"
-        ]
-        prompt_lower = prompt.lower()
-        return any(keyword in prompt_lower for keyword in search_keywords)
+        return bool(prompt) and len(prompt) >= _MIN_KW_LEN and _SEARCH_RE.search(prompt) is not None
 
-    async def get_response(self, user_messages: list, model_name: str = "deepseek", user_id: int = 0):
+    async def get_response(
+        self,
+        user_messages: list,
+        model_name: str = "deepseek",
+        user_id: int = 0,
+        username: str = "Unknown",
+        is_voice: bool = False
+    ):
         """
         Получает ответ от указанной модели.
+        Если передан user_id, сообщение учитывается в аналитике.
         """
-        if model_name == "deepseek":
-            return await self.get_deepseek_response(user_messages, user_id)
-        elif model_name == "openai":
-            return await self.get_openai_response(user_messages, user_id)
-        else:
-            return await self.get_deepseek_response(user_messages, user_id)
+        if model_name == "openai":
+            return await self.get_openai_response(user_messages, user_id, username, is_voice)
+        return await self.get_deepseek_response(user_messages, user_id, username, is_voice)
 
-    async def get_openai_response(self, user_messages: list, user_id: int = 0):
+    async def get_openai_response(
+        self,
+        user_messages: list,
+        user_id: int = 0,
+        username: str = "Unknown",
+        is_voice: bool = False
+    ):
         """
         Получает ответ от OpenAI API.
         """
-        if not os.getenv("OPENAI_API_KEY"):
-            return await self.get_deepseek_response(user_messages, user_id)
-
-        from openai import OpenAI
-        
-        openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        
-        last_user_prompt = user_messages[-1]['content']
-        search_needed = self.check_if_search_needed(last_user_prompt)
-
-        search_info = ""
-        if search_needed and self.google_search_client:
-            if "отзывы" in last_user_prompt.lower():
-                search_query = last_user_prompt.replace("отзывы", "рекомендации")
-            else:
-                search_query = last_user_prompt
-
-            logging.info(f"Выполняем поиск по запросу: {search_query}")
-            
-            if user_id:
-                try:
-                    from analytics import BotAnalytics
-                    analytics = BotAnalytics()
-                    analytics.track_search(user_id, search_query)
-                except ImportError:
-                    pass
-            
-            search_results = await self.google_search_client.search(search_query)
-
-            if search_results:
-                for item in search_results:
-                    search_info += f"Заголовок: {item.get('title')}\n"
-                    search_info += f"Ссылка: {item.get('link')}\n"
-                    search_info += f"Описание: {item.get('snippet')}\n\n"
-
-        try:
-            with open('bot_knowledge.md', 'r', encoding='utf-8') as f:
-                system_prompt = f.read()
-        except FileNotFoundError:
-            system_prompt = (
-                "Ты - эксперт по Пхукету, дружелюбный и знающий местный житель. "
-                "Отвечай кратко, без \"воды\", всегда давай только полезные советы. Используй emojis. "
-                "Используй HTML-разметку (теги <b>, <i>) для выделения важных моментов."
-            )
-
-        if search_info:
-            system_prompt += f"\n\nАктуальная информация из поиска:\n{search_info}"
+        if not self.openai_client:
+            return await self.get_deepseek_response(user_messages, user_id, username, is_voice)
 
-        messages = [{"role": "system", "content": system_prompt}] + user_messages
+        messages = await self._prepare_messages(user_messages, user_id, username, is_voice)
 
         try:
-            response = openai_client.chat.completions.create(
+            response = await self.openai_client.chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=messages,
                 max_tokens=4000,
                 temperature=0.7
             )
-            return self._convert_markdown_to_html(response.choices[0].message.content)
+            return self.convert_markdown_to_html(response.choices[0].message.content)
         except Exception as e:
             logging.error(f"Ошибка при работе с OpenAI API: {e}", exc_info=True)
-            return await self.get_deepseek_response(user_messages, user_id)
+            # Сообщения уже собраны и учтены в аналитике — повторно не готовим
+            return await self._deepseek_completion(messages)
 
-    def transcribe_audio(self, audio_file_path: str) -> str:
+    async def transcribe_audio(self, audio: BinaryIO, filename: str = "voice.ogg") -> str:
         """
-        Транскрибирует аудиофайл в текст с помощью OpenAI Whisper.
+        Транскрибирует аудио в текст с помощью OpenAI Whisper.
+        audio — бинарный поток (например, io.BytesIO);
+        filename нужен Whisper только для определения формата по расширению.
         """
         try:
-            if os.getenv("OPENAI_API_KEY"):
-                from openai import OpenAI
-                client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-                
-                with open(audio_file_path, "rb") as audio_file:
-                    transcript = client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=audio_file
-                    )
+            if self.openai_client:
+                audio_bytes = audio.read()
+                transcript = await self.openai_client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=(filename, audio_bytes)
+                )
                 return transcript.text
             else:
                 logging.warning("OpenAI API ключ не найден, транскрипция недоступна")
@@ -1,29 +1,45 @@
 import asyncio
+import hashlib
+import io
+import json
 import logging
 import os
 import re
+import time
 from inspect import iscoroutinefunction
 import contextlib
+from collections import OrderedDict
 import aiohttp  # <-- добавлено для heartbeat
 
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters.command import CommandStart
+from aiogram.filters.command import Command, CommandStart
 from aiogram.enums.chat_action import ChatAction
 from aiogram.exceptions import TelegramBadRequest
-from datetime import datetime
+from datetime import datetime, timedelta
 try:
     from zoneinfo import ZoneInfo  # py>=3.9
 except Exception:
     ZoneInfo = None
+try:
+    import orjson  # быстрее stdlib json при построении ключа кэша
+except ImportError:
+    orjson = None
+try:
+    import uvloop  # быстрый event loop на libuv (нет под Windows)
+except ImportError:
+    uvloop = None
 
 # Импортируем наш менеджер для работы с LLM
-from llm_manager import LLMManager
+from llm_manager import LLMManager, StreamInterrupted
 
 # Импортируем конфиг с ключами
 from config import TELEGRAM_BOT_TOKEN
 
 # Импортируем аналитику
-from analytics import BotAnalytics
+from analytics import get_analytics
+
+# Импортируем хранилище истории диалогов
+from history_store import HistoryStore
 
 # ---- НОВОЕ: читаем переменные окружения для heartbeat ----
 HEALTHCHECKS_PING_URL = os.getenv("HEALTHCHECKS_PING_URL", "").strip()
@@ -40,39 +56,56 @@ if not TELEGRAM_BOT_TOKEN:
 bot = Bot(token=TELEGRAM_BOT_TOKEN)
 dp = Dispatcher()
 
-# Создаем экземпляр нашего LLM менеджера
-llm_manager = LLMManager()
+# Создаем экземпляр аналитики (общий с LLM менеджером)
+analytics = get_analytics()
 
-# Создаем экземпляр аналитики
-analytics = BotAnalytics()
+# Создаем экземпляр нашего LLM менеджера
+llm_manager = LLMManager(analytics=analytics)
 
-# Словарь для хранения истории сообщений каждого пользователя + чата
-user_history = {}
+# История сообщений каждого пользователя + чата.
+# История — кольцевой буфер: старые реплики выпадают сами, промпт не растёт бесконечно.
+# Хранится в SQLite, так что контекст диалога переживает перезапуск бота
+HISTORY_MAX_MESSAGES = 40
+# Чаты без активности дольше суток забываем целиком
+HISTORY_IDLE_TTL_SEC = 24 * 60 * 60
+history_store = HistoryStore(max_messages=HISTORY_MAX_MESSAGES, idle_ttl=HISTORY_IDLE_TTL_SEC)
 
 # --- helpers для send_long_message ---
 
 MD_HEADER_RE = re.compile(r'^\s*#{1,6}\s*', flags=re.MULTILINE)
-ANCHOR_RE = re.compile(r'<a\s+href="([^"]+)">(.*?)</a>', flags=re.IGNORECASE | re.DOTALL)
+# Фолбэк в plain text разбирается одной регуляркой за один проход:
+# замена выбирается по имени сработавшей группы.
+# Заголовки здесь не трогаем — вызывающие уже прогнали текст через strip_markdown_headers
+SANITIZE_RE = re.compile(
+    r'(?P<a><a\s+href="(?P<href>[^"]+)">(?P<label>.*?)</a>)'
+    r'|(?P<br><br\s*/?>)'
+    r'|(?P<pc></p\s*>)'
+    r'|(?P<tag></?[^>]+>)',
+    flags=re.IGNORECASE | re.DOTALL
+)
+SANITIZE_REPLACEMENTS = {"br": "\n", "pc": "\n\n", "tag": ""}
+MULTI_NL_RE = re.compile(r'\n{3,}')
 
 def strip_markdown_headers(text: str) -> str:
     """Убираем markdown-заголовки вида '# Заголовок' в начале строк."""
     return MD_HEADER_RE.sub('', text)
 
-def html_to_plain(text: str) -> str:
+def _sanitize_match(match: re.Match) -> str:
+    if match.lastgroup == "a":
+        # Теги внутри подписи ссылки (<b> и т.п.) тоже вырезаем
+        label = SANITIZE_RE.sub(_sanitize_match, match.group("label"))
+        return f"{label} ({match.group('href')})"
+    return SANITIZE_REPLACEMENTS[match.lastgroup]
+
+def sanitize(text: str) -> str:
     """
-    Простой и безопасный фолбэк:
+    Простой и безопасный фолбэк в plain text:
     - <a href="URL">label</a> -> 'label (URL)'
-    - <br> -> '\n'
+    - <br> -> '\n', </p> -> '\n\n'
     - прочие теги убираем
     """
-    text = ANCHOR_RE.sub(lambda m: f"{m.group(2)} ({m.group(1)})", text)
-    text = re.sub(r'<br\s*/?>', '\n', text, flags=re.IGNORECASE)
-    text = re.sub(r'</p\s*>', '\n\n', text, flags=re.IGNORECASE)
-    text = re.sub(r'<p\s*>', '', text, flags=re.IGNORECASE)
-    text = re.sub(r'</?(?:b|i|u|em|strong|span|code|pre|blockquote|tt)>', '', text, flags=re.IGNORECASE)
-    text = re.sub(r'</?[^>]+>', '', text)
-    text = re.sub(r'\n{3,}', '\n\n', text).strip()
-    return text
+    text = SANITIZE_RE.sub(_sanitize_match, text)
+    return MULTI_NL_RE.sub('\n\n', text).strip()
 
 def split_safely(text: str, max_length: int) -> list[str]:
     """
@@ -91,12 +124,17 @@ def split_safely(text: str, max_length: int) -> list[str]:
             for sent in sentences:
                 if not sent:
                     continue
-                while len(sent) > max_length:
+                if len(sent) > max_length:
                     if current:
                         parts.append(current)
                         current = ""
-                    parts.append(sent[:max_length])
-                    sent = sent[max_length:]
+                    # Режем длинное предложение по смещениям, а хвост копируем один раз,
+                    # вместо пересоздания остатка строки на каждом шаге
+                    start = 0
+                    while len(sent) - start > max_length:
+                        parts.append(sent[start:start + max_length])
+                        start += max_length
+                    sent = sent[start:]
                 if len(current) + len(sent) + 1 > max_length:
                     if current:
                         parts.append(current)
@@ -137,95 +175,309 @@ async def send_long_message(message: types.Message, text: str, max_length: int =
         try:
             await message.reply(out, parse_mode='HTML')
         except TelegramBadRequest:
-            plain = html_to_plain(out)
+            plain = sanitize(out)
             await message.reply(plain)
 
 # --- универсальный хелпер для LLM-вызова ---
 
-async def fetch_llm_response(messages, model_name: str, user_id: int) -> str | None:
-    fn = llm_manager.get_response
-    if iscoroutinefunction(fn):
-        return await fn(messages, model_name=model_name, user_id=user_id)
+# LRU-кэш готовых ответов по точному совпадению (модель, версия базы знаний, история диалога).
+# Ответы генерируются с temperature=0.7, так что кэш лишь закрепляет один из вариантов —
+# держим его недолго, чтобы повторные вопросы не получали вечно одну и ту же формулировку
+LLM_CACHE_MAX_SIZE = 512
+LLM_CACHE_TTL_SEC = 10 * 60
+_llm_cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+# Одинаковые запросы, пришедшие одновременно (например, /start-приветствия), делят один вызов LLM
+_llm_inflight: dict[str, asyncio.Future] = {}
+
+def _llm_cache_key(messages, model_name: str) -> str | None:
+    """Ключ кэша для истории или None, если ответ кэшировать нельзя."""
+    # Ответы с результатами поиска зависят от времени — их не кэшируем
+    if llm_manager.check_if_search_needed(messages[-1]["content"]):
+        return None
+    if orjson:
+        payload = orjson.dumps(list(messages), option=orjson.OPT_SORT_KEYS)
     else:
-        return await asyncio.to_thread(fn, messages, model_name=model_name, user_id=user_id)
+        payload = json.dumps(list(messages), sort_keys=True, ensure_ascii=False).encode()
+    # Правка bot_knowledge.md меняет версию — ответы по старой базе знаний в кэше больше не находятся
+    payload += f"{model_name}:{llm_manager.knowledge_version}".encode()
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+async def _llm_reuse(key: str | None, user_id: int, username: str, is_voice: bool) -> str | None:
+    """Готовый ответ: из кэша или от такого же запроса, который уже выполняется."""
+    if key is None:
+        return None
+    response = None
+    entry = _llm_cache.get(key)
+    if entry is not None:
+        stored_at, cached = entry
+        if time.monotonic() - stored_at <= LLM_CACHE_TTL_SEC:
+            response = cached
+            _llm_cache.move_to_end(key)
+        else:
+            del _llm_cache[key]
+    if response is None:
+        pending = _llm_inflight.get(key)
+        if pending is None:
+            return None
+        response = await asyncio.shield(pending)
+        if response is None:
+            # У соседнего запроса не вышло — пусть вызывающий попробует сам
+            return None
+    # До LLM-слоя, который ведёт аналитику, дело не доходит — учитываем здесь
+    if user_id:
+        analytics.track_user_message(user_id, username, is_voice=is_voice)
+    return response
+
+@contextlib.contextmanager
+def _llm_inflight_slot(key: str | None):
+    """Помечает запрос как выполняющийся; одинаковые запросы дождутся его результата."""
+    if key is None:
+        yield None
+        return
+    future = asyncio.get_running_loop().create_future()
+    _llm_inflight[key] = future
+    try:
+        yield future
+    finally:
+        _llm_inflight.pop(key, None)
+        if not future.done():
+            future.set_result(None)
+
+def _llm_cache_put(key: str | None, response: str | None):
+    if key is None or not response:
+        return
+    _llm_cache[key] = (time.monotonic(), response)
+    if len(_llm_cache) > LLM_CACHE_MAX_SIZE:
+        _llm_cache.popitem(last=False)
+
+# Синхронная реализация get_response уходит в пул потоков; решаем это один раз при старте
+if iscoroutinefunction(llm_manager.get_response):
+    _LLM_CALL = llm_manager.get_response
+else:
+    def _LLM_CALL(*args, **kwargs):
+        return asyncio.to_thread(llm_manager.get_response, *args, **kwargs)
+
+async def fetch_llm_response(
+    messages,
+    model_name: str,
+    user_id: int,
+    username: str = "Unknown",
+    is_voice: bool = False
+) -> str | None:
+    """LLM-вызов; заодно учитывает сообщение (и поиск, если он был) в аналитике."""
+    key = _llm_cache_key(messages, model_name)
+    reused = await _llm_reuse(key, user_id, username, is_voice)
+    if reused is not None:
+        return reused
+
+    with _llm_inflight_slot(key) as slot:
+        response = await _LLM_CALL(
+            messages, model_name=model_name, user_id=user_id, username=username, is_voice=is_voice
+        )
+
+        _llm_cache_put(key, response)
+        if slot:
+            slot.set_result(response)
+    return response
+
+# Как часто обновлять сообщение с ответом во время стриминга
+STREAM_EDIT_MIN_CHARS = 400
+STREAM_EDIT_INTERVAL_SEC = 1.5
+
+async def stream_llm_response(
+    progress_msg: types.Message,
+    messages,
+    model_name: str,
+    user_id: int,
+    username: str = "Unknown",
+    max_length: int = 4000
+) -> str | None:
+    """
+    Как fetch_llm_response, но ответ стримится: progress_msg по ходу генерации
+    обновляется текущим текстом (plain, т.к. незакрытый HTML Telegram не примет).
+    Возвращает полный ответ в HTML или None, если ответа нет или поток оборвался.
+    """
+    key = _llm_cache_key(messages, model_name)
+    reused = await _llm_reuse(key, user_id, username, False)
+    if reused is not None:
+        return reused
+
+    with _llm_inflight_slot(key) as slot:
+        chunks = []
+        length = 0
+        edited_length = 0
+        edited_at = time.monotonic()
+        try:
+            async for chunk in llm_manager.stream_response(
+                messages, model_name=model_name, user_id=user_id, username=username
+            ):
+                chunks.append(chunk)
+                length += len(chunk)
+                if (length - edited_length >= STREAM_EDIT_MIN_CHARS
+                        or time.monotonic() - edited_at >= STREAM_EDIT_INTERVAL_SEC):
+                    text = "".join(chunks)
+                    with contextlib.suppress(Exception):
+                        await progress_msg.edit_text(text[-max_length:])
+                    edited_length = length
+                    edited_at = time.monotonic()
+        except StreamInterrupted:
+            # Обрезанный ответ не кэшируем и в историю не кладём — как и при ошибке без стриминга
+            return None
+
+        if not chunks:
+            return None
+        response = llm_manager.convert_markdown_to_html("".join(chunks))
+        _llm_cache_put(key, response)
+        if slot:
+            slot.set_result(response)
+    return response
+
+async def finish_streamed_reply(
+    message: types.Message,
+    progress_msg: types.Message,
+    text: str,
+    max_length: int = 4000
+) -> bool:
+    """
+    Ставит готовый ответ на место стрим-превью.
+    Возвращает True, если ответ уместился в progress_msg; длинный ответ уходит через send_long_message.
+    """
+    text = strip_markdown_headers(text)
+    if len(text) > max_length:
+        await send_long_message(message, text, max_length)
+        return False
+    try:
+        await progress_msg.edit_text(text, parse_mode='HTML')
+    except TelegramBadRequest:
+        # "message is not modified" — превью уже совпадает с итоговым текстом
+        with contextlib.suppress(TelegramBadRequest):
+            await progress_msg.edit_text(sanitize(text))
+    return True
 
 # --- индикатор прогресса ---
 
+PROGRESS_EDIT_DELAY_SEC = 3.0
+
 async def progress_notifier(bot: Bot, chat_id: int, message_id: int, stop_event: asyncio.Event):
     """
-    Анимация: 'Окей-кап⏳', 'Окей-кап..⌛️', 'Окей-кап...⏳'
+    Если ответ не готов за PROGRESS_EDIT_DELAY_SEC секунд — один раз обновляем
+    индикатор ('Окей-кап⏳' -> 'Окей-кап...⏳') и просто ждём завершения,
+    не дёргая Bot API каждую секунду. После stop_event убираем индикатор.
     """
-    frames = ["Окей-кап⏳", "Окей-кап..⌛️", "Окей-кап...⏳"]
-    idx = 0
     try:
-        while not stop_event.is_set():
-            try:
-                await bot.edit_message_text(frames[idx % len(frames)], chat_id, message_id, parse_mode='HTML')
-            except Exception:
-                pass
-            idx += 1
-            await asyncio.sleep(1)  # шаг анимации
-    except Exception as e:
-        logging.error(f"progress_notifier error: {e}")
+        await asyncio.wait_for(stop_event.wait(), timeout=PROGRESS_EDIT_DELAY_SEC)
+    except asyncio.TimeoutError:
+        with contextlib.suppress(Exception):
+            await bot.edit_message_text("Окей-кап...⏳", chat_id, message_id, parse_mode='HTML')
+        await stop_event.wait()
+    try:
+        await bot.delete_message(chat_id, message_id)
+    except Exception:
+        with contextlib.suppress(Exception):
+            await bot.edit_message_text("✅ Готово", chat_id, message_id)
 
 # --- Healthcheck heartbeat (НОВОЕ) ---
 
-async def heartbeat_task():
+# Пингу не нужно тело ответа и стандартные заголовки: HEAD без User-Agent/Accept-Encoding
+HEARTBEAT_REQUEST_KWARGS = dict(
+    skip_auto_headers=("User-Agent", "Accept-Encoding"),
+    allow_redirects=False
+)
+
+async def heartbeat_task(session: aiohttp.ClientSession):
     """
     Периодически пингует Healthchecks.
     Если процесс упадёт или Replit остановит workflow — пинги прекратятся,
     и Healthchecks пришлёт алерт в Telegram.
+    Использует общую сессию: keep-alive соединение переживает между пингами.
     """
     if not HEALTHCHECKS_PING_URL:
         logging.info("heartbeat: HEALTHCHECKS_PING_URL is empty, skipping.")
         return
 
-    timeout = aiohttp.ClientTimeout(total=10)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        # Однократный старт-пинг (не обязателен, но полезен для диагностики)
-        with contextlib.suppress(Exception):
-            await session.get(f"{HEALTHCHECKS_PING_URL}/start")
+    # Однократный старт-пинг (не обязателен, но полезен для диагностики)
+    with contextlib.suppress(Exception):
+        async with session.head(f"{HEALTHCHECKS_PING_URL}/start", **HEARTBEAT_REQUEST_KWARGS):
+            pass
 
-        while True:
-            try:
-                await session.get(HEALTHCHECKS_PING_URL)
-                logging.debug("heartbeat: ping ok")
-            except Exception as e:
-                # Отсутствие пингов — и есть сигнал для алерта, поэтому просто логируем
-                logging.warning(f"heartbeat: ping failed: {e}")
-            await asyncio.sleep(HEARTBEAT_INTERVAL_SEC)
+    while True:
+        try:
+            # async with возвращает соединение в пул, иначе оно не переиспользуется
+            async with session.head(HEALTHCHECKS_PING_URL, **HEARTBEAT_REQUEST_KWARGS):
+                pass
+            logging.debug("heartbeat: ping ok")
+        except Exception as e:
+            # Отсутствие пингов — и есть сигнал для алерта, поэтому просто логируем
+            logging.warning(f"heartbeat: ping failed: {e}")
+        await asyncio.sleep(HEARTBEAT_INTERVAL_SEC)
 
 # --- обработчики ---
 
+try:
+    PHUKET_TZ = ZoneInfo("Asia/Bangkok") if ZoneInfo else None  # Пхукет = Азия/Бангкок
+except Exception:
+    PHUKET_TZ = None
+
+# (monotonic-время расчёта, строка) — всплески вопросов о времени отдаём из кэша
+_time_cache = (0.0, "")
+TIME_CACHE_TTL_SEC = 1.0
+
 def phuket_now_str() -> str:
     """Текущее время на Пхукете (UTC+7) в удобном формате."""
-    if ZoneInfo:
-        now = datetime.now(ZoneInfo("Asia/Bangkok"))  # Пхукет = Азия/Бангкок
+    global _time_cache
+    now_mono = time.monotonic()
+    cached_at, cached = _time_cache
+    if cached and now_mono - cached_at < TIME_CACHE_TTL_SEC:
+        return cached
+
+    if PHUKET_TZ:
+        now = datetime.now(PHUKET_TZ)
     else:
         # Фолбэк: берём системное UTC и прибавляем 7 часов
         now = datetime.utcnow() + timedelta(hours=7)
-    return now.strftime("%d.%m.%Y • %H:%M (UTC+7)")
-
-@dp.message(lambda m: m.text and m.text.strip().lower() in {"/time", "time", "время"})
-async def time_command(message: types.Message):
-    await message.reply(f"Сейчас на Пхукете: <b>{phuket_now_str()}</b>", parse_mode="HTML")
-
-# Перехват естественных вопросов: "сколько времени", "какое сейчас время", "time in Phuket" и т.п.
-TIME_PAT = re.compile(
-    r"(скол(ь|ъ)ко.*врем|како(е|й).*врем|сейчас.*врем|time.*phuket|current.*time.*phuket|время.*пхукет)",
+    result = now.strftime("%d.%m.%Y • %H:%M (UTC+7)")
+    _time_cache = (now_mono, result)
+    return result
+
+# Детерминированные интенты, на которые отвечаем без модели.
+# Все шаблоны собраны в одну регулярку: один проход по тексту определяет интент (по имени группы).
+# Команды /time и /время ловит фильтр Command, здесь — только текст без слэша
+INTENT_RE = re.compile(
+    r"(?P<time_command>^\s*(?:time|время)\s*$)"
+    # Естественные вопросы: "сколько времени", "какое сейчас время", "time in Phuket" и т.п.
+    r"|(?P<time_question>скол[ьъ]ко.*врем|како[ей].*врем|сейчас.*врем|time.*phuket|current.*time.*phuket|время.*пхукет)",
     re.IGNORECASE
 )
+# Подстроки, без которых INTENT_RE заведомо не сработает
+INTENT_KEYWORDS = ("врем", "time")
 
-@dp.message(lambda m: m.text and TIME_PAT.search(m.text))
-async def handle_time_question(message: types.Message):
+@dp.message(Command("time", "время", ignore_case=True))
+async def reply_phuket_time(message: types.Message):
     # Отвечаем детерминированно и не зовём модель
     await message.reply(f"Сейчас на Пхукете: <b>{phuket_now_str()}</b>", parse_mode="HTML")
 
+INTENT_HANDLERS = {
+    "time_command": reply_phuket_time,
+    "time_question": reply_phuket_time,
+}
+
+def has_intent_keyword(text: str | None) -> bool:
+    """Дешёвый префильтр: каждое совпадение INTENT_RE содержит одно из INTENT_KEYWORDS."""
+    if not text:
+        return False
+    text = text.lower()
+    return any(keyword in text for keyword in INTENT_KEYWORDS)
+
+# Регулярка запускается только для редких сообщений, прошедших префильтр
+@dp.message(F.text.func(has_intent_keyword), F.text.regexp(INTENT_RE, mode="search").as_("intent_match"))
+async def handle_intent(message: types.Message, intent_match: re.Match):
+    await INTENT_HANDLERS[intent_match.lastgroup](message)
+
 @dp.message(CommandStart())
 async def send_welcome(message: types.Message):
     if message.from_user and message.chat:
         chat_key = f"{message.from_user.id}_{message.chat.id}"
-        user_history[chat_key] = []
+        history_store.reset(chat_key)
     await message.reply(
         "Привет! 👋\n"
         "Я твой персональный нейро-эксперт по Пхукету! 🏝️\n\n"
@@ -237,21 +489,29 @@ async def send_welcome(message: types.Message):
         "Просто спроси меня о чём-нибудь, связанным с Пхукетом! 😉\n\n"
         "<i>Команды для админа:</i>\n"
         "/stats - статистика использования\n"
-        "/topusers - топ активных пользователей"
+        "/topusers - топ активных пользователей\n"
+        "/cacheclear - очистить кэш ответов"
     )
 
-@dp.message(lambda message: message.text and message.text.startswith('/stats'))
+@dp.message(Command("stats"))
 async def send_stats(message: types.Message):
     if message.from_user:
         stats_summary = analytics.get_summary()
         await message.reply(stats_summary, parse_mode='HTML')
 
-@dp.message(lambda message: message.text and message.text.startswith('/topusers'))
+@dp.message(Command("topusers"))
 async def send_top_users(message: types.Message):
     if message.from_user:
         top_users = analytics.get_top_users(10)
         await message.reply(top_users, parse_mode='HTML')
 
+@dp.message(Command("cacheclear"))
+async def clear_llm_cache(message: types.Message):
+    if message.from_user:
+        size = len(_llm_cache)
+        _llm_cache.clear()
+        await message.reply(f"🧹 Кэш ответов очищен ({size} записей).")
+
 @dp.message(F.voice)
 async def handle_voice_message(message: types.Message):
     if not message.from_user or not message.voice:
@@ -263,61 +523,70 @@ async def handle_voice_message(message: types.Message):
 
     logging.info(f"Получено голосовое сообщение от {username} в чате {message.chat.id}")
 
-    analytics.track_user_message(user_id, username, is_voice=True)
-
     # Индикатор
     progress_msg = await bot.send_message(message.chat.id, "Окей-кап⏳", parse_mode='HTML')
     stop_event = asyncio.Event()
-    progress_task = asyncio.create_task(progress_notifier(bot, message.chat.id, progress_msg.message_id, stop_event))
-
-    try:
-        if chat_key not in user_history:
-            user_history[chat_key] = []
-
-        voice_file = await bot.get_file(message.voice.file_id)
-        if not voice_file.file_path:
-            await message.reply("Не удалось получить голосовое сообщение.")
-            return
-
-        audio_filename = f"voice_{message.from_user.id}.ogg"
-        await bot.download_file(voice_file.file_path, audio_filename)
+    # Сообщение учитывается в аналитике ровно один раз: здесь или в LLM-слое
+    tracked = False
+    # Выход из группы дожидается, пока индикатор уберёт за собой сообщение
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(progress_notifier(bot, message.chat.id, progress_msg.message_id, stop_event))
 
-        recognized_text = llm_manager.transcribe_audio(audio_filename)
-        os.remove(audio_filename)
-
-        if not recognized_text:
-            await message.reply("Извини, не удалось распознать твою речь. Попробуй, пожалуйста, еще раз.")
-            return
-
-        user_history[chat_key].append({"role": "user", "content": recognized_text})
-
-        response_text = await fetch_llm_response(
-            user_history[chat_key],
-            model_name="deepseek",
-            user_id=user_id
-        )
-
-        if response_text:
-            user_history[chat_key].append({"role": "assistant", "content": response_text})
-            await send_long_message(message, response_text)
-        else:
-            await progress_msg.edit_text("🙈 Не смог получить ответ, попробуй ещё раз.")
+        try:
+            history = await history_store.get(chat_key)
+
+            voice_file = await bot.get_file(message.voice.file_id)
+            if not voice_file.file_path:
+                # До LLM дело не дошло — учитываем сообщение здесь
+                analytics.track_user_message(user_id, username, is_voice=True)
+                tracked = True
+                await message.reply("Не удалось получить голосовое сообщение.")
+                return
+
+            # Качаем голосовое сразу в память, без временного .ogg на диске
+            audio = io.BytesIO()
+            await bot.download_file(voice_file.file_path, audio)
+            audio.seek(0)
+
+            recognized_text = await llm_manager.transcribe_audio(audio, filename="voice.ogg")
+
+            if not recognized_text:
+                analytics.track_user_message(user_id, username, is_voice=True)
+                tracked = True
+                await message.reply("Извини, не удалось распознать твою речь. Попробуй, пожалуйста, еще раз.")
+                return
+
+            history.append({"role": "user", "content": recognized_text})
+            history_store.mark_dirty(chat_key)
+
+            tracked = True
+            response_text = await fetch_llm_response(
+                history,
+                model_name="deepseek",
+                user_id=user_id,
+                username=username,
+                is_voice=True
+            )
+
+            if response_text:
+                history.append({"role": "assistant", "content": response_text})
+                history_store.mark_dirty(chat_key)
+                await send_long_message(message, response_text)
+            else:
+                await progress_msg.edit_text("🙈 Не смог получить ответ, попробуй ещё раз.")
 
-        logging.info(f"Отправлен ответ на голосовое сообщение: {response_text}")
+            logging.info(f"Отправлен ответ на голосовое сообщение: {response_text}")
 
-    except Exception as e:
-        logging.error(f"Произошла ошибка при обработке голосового сообщения: {e}", exc_info=True)
-        await message.reply("Извини, произошла какая-то ошибка. Попробуй ещё раз позже.")
-    finally:
-        stop_event.set()
-        await progress_task
-        try:
-            await bot.delete_message(message.chat.id, progress_msg.message_id)
-        except Exception:
-            try:
-                await progress_msg.edit_text("✅ Готово")
-            except Exception:
-                pass
+        except Exception as e:
+            logging.error(f"Произошла ошибка при обработке голосового сообщения: {e}", exc_info=True)
+            # Ничего не должно вылететь из группы: иначе она отменит индикатор до того, как он уберёт сообщение
+            with contextlib.suppress(Exception):
+                if not tracked:
+                    # Упали до LLM (get_file/download_file/распознавание) — учитываем сообщение здесь
+                    analytics.track_user_message(user_id, username, is_voice=True)
+                await message.reply("Извини, произошла какая-то ошибка. Попробуй ещё раз позже.")
+        finally:
+            stop_event.set()
 
 @dp.message()
 async def handle_text_message(message: types.Message):
@@ -331,28 +600,28 @@ async def handle_text_message(message: types.Message):
 
     logging.info(f"Получено сообщение от {username} в чате {message.chat.id}: {user_text}")
 
-    analytics.track_user_message(user_id, username, is_voice=False)
-
-    # Индикатор
-    progress_msg = await bot.send_message(message.chat.id, "Окей-кап⏳", parse_mode='HTML')
-    stop_event = asyncio.Event()
-    progress_task = asyncio.create_task(progress_notifier(bot, message.chat.id, progress_msg.message_id, stop_event))
+    # Индикатор; по мере генерации в нём же появляется ответ
+    progress_msg = await message.reply("Окей-кап⏳", parse_mode='HTML')
+    answered_in_progress_msg = False
 
     try:
-        if chat_key not in user_history:
-            user_history[chat_key] = []
+        history = await history_store.get(chat_key)
 
-        user_history[chat_key].append({"role": "user", "content": user_text})
+        history.append({"role": "user", "content": user_text})
+        history_store.mark_dirty(chat_key)
 
-        response_text = await fetch_llm_response(
-            user_history[chat_key],
+        response_text = await stream_llm_response(
+            progress_msg,
+            history,
             model_name="deepseek",
-            user_id=user_id
+            user_id=user_id,
+            username=username
         )
 
         if response_text:
-            user_history[chat_key].append({"role": "assistant", "content": response_text})
-            await send_long_message(message, response_text)
+            history.append({"role": "assistant", "content": response_text})
+            history_store.mark_dirty(chat_key)
+            answered_in_progress_msg = await finish_streamed_reply(message, progress_msg, response_text)
         else:
             await progress_msg.edit_text("🙈 Не смог получить ответ, попробуй ещё раз.")
 
@@ -362,33 +631,54 @@ async def handle_text_message(message: types.Message):
         logging.error(f"Произошла ошибка при обработке сообщения: {e}", exc_info=True)
         await message.reply("Извини, произошла какая-то ошибка. Попробуй ещё раз позже.")
     finally:
-        stop_event.set()
-        await progress_task
-        try:
-            await bot.delete_message(message.chat.id, progress_msg.message_id)
-        except Exception:
+        if not answered_in_progress_msg:
             try:
-                await progress_msg.edit_text("✅ Готово")
+                await bot.delete_message(message.chat.id, progress_msg.message_id)
             except Exception:
-                pass
+                try:
+                    await progress_msg.edit_text("✅ Готово")
+                except Exception:
+                    pass
 
 async def main():
-    # Безопасный запуск heartbeat (если URL задан)
-    hb_task = None
-    try:
-        if HEALTHCHECKS_PING_URL:
-            hb_task = asyncio.create_task(heartbeat_task())
-            logging.info("heartbeat: started (%ss)", HEARTBEAT_INTERVAL_SEC)
+    # py>=3.12: задачи выполняются синхронно до первого реального ожидания,
+    # без лишнего круга через планировщик
+    if hasattr(asyncio, "eager_task_factory"):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+
+    # Одна HTTP-сессия на весь процесс для наших собственных запросов
+    http_session = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=10),
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60, ttl_dns_cache=300)
+    )
 
-        await bot.delete_webhook(drop_pending_updates=True)
-        logging.info("Бот запущен!")
-        await dp.start_polling(bot)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            # Фоновый сброс статистики и истории на диск, забывание неактивных чатов
+            background = [
+                tg.create_task(analytics.flush_loop()),
+                tg.create_task(history_store.flush_loop()),
+                tg.create_task(history_store.eviction_loop()),
+            ]
+            # Безопасный запуск heartbeat (если URL задан)
+            if HEALTHCHECKS_PING_URL:
+                background.append(tg.create_task(heartbeat_task(http_session)))
+                logging.info("heartbeat: started (%ss)", HEARTBEAT_INTERVAL_SEC)
+
+            await bot.delete_webhook(drop_pending_updates=True)
+            logging.info("Бот запущен!")
+            await dp.start_polling(bot)
+            # Фоновые циклы бесконечные: после остановки поллинга гасим их, группа дождётся завершения
+            for task in background:
+                task.cancel()
     finally:
-        if hb_task:
-            hb_task.cancel()
-            with contextlib.suppress(Exception):
-                await hb_task
+        analytics.checkpoint()
+        history_store.close()
+        await http_session.close()
         logging.info("Bot shutdown complete.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())